@@ -64,7 +64,7 @@ paste-buffer [args]
 send-keys [args]
   Identical to tmux send-keys, except with the pane already specified.
   This is useful for sending special keys such as `Enter`, since smux's
-  normal mode of operation is to send all keys literally.
+  normal mode of operation is to paste each command literally.
 waitForString <string> [pollingInterval] [numLinesToExamine]
   Wait until the given string appears in the last line of the target pane
   before executing or sending the next command. Note that this directive
@@ -72,9 +72,11 @@ waitForString <string> [pollingInterval] [numLinesToExamine]
   the string it is waiting for appears on the screen and stays on the
   screen persistently until user input is received. That means it is
   appropriate for waiting for shell or password prompts, but not waiting
-  for a particular line to appear in a streaming log. The polling interval
-  (default 1 second) and the number of lines examined can be overriden by
-  passing additional arguments.
+  for a particular line to appear in a streaming log. The pane is checked
+  once per polling interval (default 1 second), and also soon after it
+  produces output, though not more than five times a second unless the
+  polling interval is shorter. The polling interval and the number of lines
+  examined can be overriden by passing additional arguments.
 waitForRegex <regex> [pollingInterval] [numLinesToExamine]
   Identical to waitForString except that the first argument is treated as a
   Python regular expression rather than a literal string.
@@ -115,28 +117,338 @@ import os
 import sys
 import time
 import re
-from subprocess import Popen, PIPE
+from subprocess import Popen, PIPE, DEVNULL, run
 import traceback
 import shlex
 import threading
+from collections import deque
+from itertools import groupby, islice
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 
-totalPanes = 0
 MAX_PANES = 500
 
 ################################################################################
 # Core utility functions. These are define dfirst because global variable
 # assignments depend on them.
 ################################################################################
+class TmuxPipe:
+    """
+    A persistent tmux control mode client attached to a single session.
+
+    Commands are written as lines to the stdin of one long-lived `tmux -C`
+    process and their output is read back from between the `%begin` and
+    `%end` (or `%error`) guard lines of the control mode protocol, so that
+    running a command does not require forking a shell and a new tmux client.
+    See the CONTROL MODE section of the tmux man page for details.
+
+    Replies are read by a background thread, which also watches the `%output`
+    notifications of any panes that smux is waiting on.
+    """
+    def __init__(self, session):
+        self.proc = Popen(["tmux", "-C", "attach-session", "-t", f"={session}"],
+                          stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+        self.lock = threading.Lock()
+        self.closed = False
+        # Futures for the replies to the commands that have been written, in
+        # the order that they were written. The first is for the
+        # attach-session itself.
+        attached = Future()
+        self.pending = deque([attached])
+        # Events to set when the pane with a given id produces output.
+        self.watchers = {}
+        self.watchLock = threading.Lock()
+        self.streaming = False
+        threading.Thread(target=self.readReplies, daemon=True).start()
+        try:
+            attached.result()
+            # Pane output is streamed to control clients as notifications,
+            # which are not needed until some pane is watched. This
+            # also fails if the client exited because the attach failed.
+            self.send("refresh-client -f no-output")
+        except (OSError, EOFError):
+            self.proc.kill()
+            self.proc.wait()
+            raise
+
+    def readLine(self):
+        line = self.proc.stdout.readline()
+        if not line:
+            raise EOFError("tmux control client exited")
+        return line
+
+    def readBlock(self):
+        """
+        Read the next guarded block of output, handling any notifications before it.
+
+        Returns the flags of the block and the output of the command, or empty
+        bytes if it failed, which mirrors what a tmux client would have printed
+        to stdout. The flags are b"1" for commands sent by this client.
+        """
+        line = self.readLine()
+        while not line.startswith(b"%begin "):
+            if line.startswith(b"%output "):
+                watcher = self.watchers.get(line.split(b" ", 2)[1])
+                if watcher:
+                    watcher.set()
+            line = self.readLine()
+        # The time and command number identify the matching guard line, since
+        # the output itself may contain lines beginning with %end.
+        guard = line.split()[1:3]
+        flags = line.split()[3]
+        output = []
+        line = self.readLine()
+        while not (line.startswith((b"%end ", b"%error ")) and line.split()[1:3] == guard):
+            output.append(line)
+            line = self.readLine()
+        return flags, b"".join(output) if line.startswith(b"%end ") else b""
+
+    def readReplies(self):
+        """Hand each reply to the oldest pending command until tmux exits."""
+        try:
+            # tmux also guards the output of commands run by hooks, which are
+            # flagged differently from those sent by this client. Only the
+            # reply to the attach-session itself is flagged the same way.
+            attached = False
+            while True:
+                flags, output = self.readBlock()
+                if attached and flags != b"1":
+                    continue
+                attached = True
+                if self.pending:
+                    self.pending.popleft().set_result(output)
+        except (OSError, EOFError, ValueError):
+            pass
+        with self.lock:
+            self.closed = True
+            while self.pending:
+                self.pending.popleft().set_exception(
+                    EOFError("tmux control client exited"))
+
+    def submit(self, cmd):
+        """
+        Write the given tmux command without waiting for it to finish.
+
+        The command is given in the same form as to tcmd, so a separate `;`
+        argument separates multiple commands. Returns a Future for the output
+        of each of them.
+        """
+        commands = splitTmuxCommands(tmuxArgs(cmd))
+        futures = [Future() for _ in commands]
+        with self.lock:
+            if self.closed:
+                raise EOFError("tmux control client exited")
+            # The futures must be queued before the reader can see the replies.
+            self.pending.extend(futures)
+            self.proc.stdin.write(b"".join(x.encode("utf-8") + b"\n" for x in commands))
+            self.proc.stdin.flush()
+        return futures
+
+    def send(self, cmd):
+        """Run the given tmux command and return its output."""
+        return b"".join([x.result() for x in self.submit(cmd)])
+
+    def watchPane(self, paneId):
+        """
+        Return an Event that is set whenever the pane with the given id, such
+        as b"%3", produces output, until unwatchPane is called for it.
+        """
+        with self.watchLock:
+            if not self.streaming:
+                # Once turned on, the streaming of pane output is left on,
+                # since tmux 3.3 can stop replying to commands if no-output
+                # is set again while output is still queued for this client.
+                self.streaming = True
+                self.send("refresh-client -f !no-output")
+            return self.watchers.setdefault(paneId, threading.Event())
+
+    def unwatchPane(self, paneId):
+        self.watchers.pop(paneId, None)
+
+    def sync(self):
+        """Wait until tmux has replied to every command written so far."""
+        with self.lock:
+            pending = list(self.pending)
+        wait(pending)
+
+    def close(self):
+        # Commands written with submit may still be queued behind each other.
+        self.sync()
+        self.proc.stdin.close()
+        self.proc.wait()
+
+
+def quoteTmuxArgument(arg):
+    """Quote a single argument for the tmux command parser."""
+    if arg and SAFE_TMUX_ARGUMENT.fullmatch(arg):
+        return arg
+    # Escape the characters that are special inside double quotes with
+    # str.replace, which is much faster than mapping every character.
+    arg = arg.replace('\\', '\\\\').replace('"', '\\"').replace('$', '\\$')
+    # Line breaks are escaped so that each command stays on a single line.
+    # Only the escapes below are used, since the command parser before tmux
+    # 3.0 knows no others, such as octal escapes. Other control characters
+    # are taken literally inside double quotes.
+    if TMUX_CONTROL_CHARACTER.search(arg):
+        arg = TMUX_CONTROL_CHARACTER.sub(lambda m: TMUX_ESCAPES[m.group()], arg)
+    return '"' + arg + '"'
+
+# Arguments made only of these characters need no quoting.
+SAFE_TMUX_ARGUMENT = re.compile(r"[\w@+=:,./-]+", re.ASCII)
+TMUX_CONTROL_CHARACTER = re.compile(r"[\n\r\t\x1b]")
+TMUX_ESCAPES = {"\n": "\\n", "\r": "\\r", "\t": "\\t", "\x1b": "\\e"}
+
+
+def tmuxArgs(cmd):
+    """
+    Return the arguments to tmux for the given command.
+
+    Commands may be given either as a list of arguments, or as a string which
+    is split into arguments the same way a shell would.
+    """
+    if isinstance(cmd, str):
+        return shlex.split(cmd)
+    return list(cmd)
+
+
+def execArgs(args):
+    r"""
+    Return the given tmux arguments in the form to run tmux with.
+
+    When run directly, tmux treats a trailing `;` on any argument as a command
+    separator, so it is escaped as `\;` on every argument that is not itself a
+    separator.
+    """
+    return [x[:-1] + "\\;" if x.endswith(";") and x != ";" and not x.endswith("\\;")
+            else x for x in args]
+
+
+def splitTmuxCommands(cmdArgs):
+    """
+    Split a list of tmux arguments into one control mode command line per `;`
+    separated tmux command.
+    """
+    commands = []
+    args = []
+    for arg in cmdArgs + [";"]:
+        if arg != ";":
+            args.append(arg)
+        elif args:
+            commands.append(" ".join(quoteTmuxArgument(x) for x in args))
+            args = []
+    return commands
+
+
+# The control mode client for the session that smux is populating, if any.
+controlPipe = None
+
+
+def openControlPipe():
+    """Attach a control mode client to sessionName if tmux supports it."""
+    global controlPipe
+    try:
+        controlPipe = TmuxPipe(sessionName)
+    except (OSError, EOFError):
+        controlPipe = None
+
+
+def closeControlPipe():
+    """Detach the control mode client, if any."""
+    global controlPipe
+    if controlPipe:
+        controlPipe.close()
+        controlPipe = None
+
+
+def syncControlPipe():
+    """Wait until tmux has run the commands already sent to the control pipe."""
+    pipe = controlPipe
+    if pipe:
+        pipe.sync()
+
+
+def pipeSubmit(cmd):
+    """
+    Write the given tmux command to the control pipe without waiting for it.
+
+    Returns False if there is no working control pipe, in which case the
+    command was not run.
+    """
+    global controlPipe
+    pipe = controlPipe
+    if not pipe:
+        return False
+    try:
+        pipe.submit(cmd)
+        return True
+    except (OSError, EOFError, ValueError):
+        controlPipe = None
+        return False
+
+
+def pipeGet(cmd):
+    """
+    Run the given tmux command over the control pipe and return its output, or
+    None if there is no working control pipe.
+    """
+    global controlPipe
+    pipe = controlPipe
+    if not pipe:
+        return None
+    try:
+        return pipe.send(cmd)
+    except (OSError, EOFError, ValueError):
+        # The control client went away, so fall back to forking clients.
+        controlPipe = None
+        return None
+
+
 def tcmd(cmd):
-    """Execute the given tmux command synchronously and ignore any output."""
-    os.system("tmux %s" % cmd)
+    """
+    Execute the given tmux command and ignore any output.
+
+    The command may be a list of arguments to tmux, such as
+    `["send-keys", "-t", "0.1", "Enter"]`, or a string which is split into
+    arguments the same way as by a shell.
+
+    With a control pipe, this returns as soon as the command is written, so
+    that successive commands are pipelined instead of each waiting for a
+    round trip. tmux runs a client's commands in order, so later commands
+    and tget still see its effects. Use syncControlPipe before anything
+    outside the pipe, such as a shell, depends on them.
+    """
+    if not pipeSubmit(cmd):
+        spawnTmux(execArgs(tmuxArgs(cmd)))
+
+
+def spawnTmux(args):
+    """
+    Run tmux with the given arguments and wait for it to exit, discarding
+    its output. Errors are discarded as well, as they are for commands sent
+    through the control pipe.
+
+    Nothing is read back from the child, so this uses posix_spawn directly
+    rather than the pipes, locks and bookkeeping of subprocess. File
+    descriptors are not inheritable by default since Python 3.4, so the
+    child gets only stdin, stdout and stderr without closing anything.
+    """
+    pid = os.posix_spawnp("tmux", ["tmux", *args], os.environ, file_actions=[
+        (os.POSIX_SPAWN_OPEN, 1, os.devnull, os.O_WRONLY, 0),
+        (os.POSIX_SPAWN_DUP2, 1, 2)])
+    os.waitpid(pid, 0)
 
 
 def tget(cmd):
-    """Execute the given tmux command synchronously and return any output."""
-    proc = Popen("tmux %s" % cmd, stdout=PIPE, stderr=PIPE, shell=True)
-    out, err = proc.communicate()
-    exitcode = proc.returncode
+    """
+    Execute the given tmux command synchronously and return any output.
+
+    The command is given in the same form as to tcmd.
+    """
+    out = pipeGet(cmd)
+    if out is not None:
+        return out
+    proc = Popen(["tmux", *execArgs(tmuxArgs(cmd))], stdout=PIPE,
+                 stderr=DEVNULL, close_fds=False)
+    out, _ = proc.communicate()
     return out
 ################################################################################
 
@@ -148,35 +460,32 @@ tmux = os.environ.get('TMUX')
 # call can be active at any point in time in a given process.
 sessionName = None
 if tmux:
-    sessionName = tget("display-message -p '#{session_name}'").decode('utf-8').strip()
+    sessionName = tget(["display-message", "-p", "#{session_name}"]).decode('utf-8').strip()
 
 
 def splitWindow():
     """Split the current pane horizontally."""
-    global totalPanes
-    global MAX_PANES
-    if totalPanes < MAX_PANES:
-        tcmd("split-window -d -h")
-        totalPanes += 1
+    tcmd(["split-window", "-d", "-h"])
 
 
 def newWindow():
     """Create a new tmux window and make it current."""
-    global totalPanes
-    global MAX_PANES
-    if totalPanes < MAX_PANES:
-        tcmd("new-window")
-        totalPanes += 1
+    tcmd(["new-window"])
 
 
 def getCurrentWindow():
     """Retrieve the current window index as an int."""
-    return int(tget("display-message -p '#I'"))
+    return int(tget(["display-message", "-p", "#I"]))
 
 
 def getCurrentPane():
     """Retrieve the current pane index as an int."""
-    return int(tget("display-message -p '#P'"))
+    return int(tget(["display-message", "-p", "#P"]))
+
+
+def paneTarget(window, pane):
+    """Return the tmux target for the given window and pane in this session."""
+    return f"={sessionName}:{window}.{pane}"
 
 
 def carvePanes(numPanes, layout):
@@ -193,11 +502,50 @@ def carvePanes(numPanes, layout):
       "even-horizontal", "even-vertical", "main-horizontal", "main-vertical",
       "tiled".
     """
-    for i in range(numPanes - 1):
-        splitWindow()
-        tcmd("select-layout %s" % layout)
-    tcmd("select-layout %s" % layout)
-    return getCurrentWindow()
+    # Split all the panes, set the layout and report the window with a single
+    # tmux command list. The layout is still selected after every split,
+    # because it rebalances the panes so that there is space for the next one.
+    numSplits = max(0, numPanes - 1)
+    selectLayout = ["select-layout", layout, ";"]
+    commands = (["split-window", "-d", "-h", ";", *selectLayout] * numSplits
+                or selectLayout)
+    window = tget([*commands, "display-message", "-p", "#I"])
+    if not window:
+        # A split failed, such as for lack of room in the window. Through the
+        # control pipe each command runs on its own, but a tmux client
+        # abandons the rest of its command list, so finish the job here.
+        tcmd(["select-layout", layout])
+        return getCurrentWindow()
+    return int(window)
+
+
+def waitForWindowReady(window, timeout=0.5):
+    """
+    Block calling thread until every pane in the specified window has drawn
+    its first output, such as a shell prompt, or until timeout seconds have
+    passed.
+
+    This gives the tty of a new pane time to notice its final dimensions.
+    Empirically, this prevents commands like `man tmux` from rendering with
+    incorrect dimensions. All the panes are checked with one tmux command,
+    polled with exponential backoff, so a window that is already ready costs
+    a single tmux command.
+    """
+    deadline = time.monotonic() + timeout
+    delay = 0.005
+    target = f"={sessionName}:{window}"
+    while True:
+        cursors = tget(["list-panes", "-t", target, "-F",
+                        "#{cursor_x},#{cursor_y}"]).split()
+        if (cursors and b"0,0" not in cursors) or time.monotonic() >= deadline:
+            return
+        time.sleep(min(delay, max(0, deadline - time.monotonic())))
+        delay = min(2 * delay, 0.05)
+
+
+# The shortest time in seconds between two checks of a pane which waitForString
+# or waitForRegex make because the pane produced output.
+OUTPUT_CHECK_GAP = 0.2
 
 
 def waitForStringOrRegex(window, pane, args, isRegex):
@@ -227,8 +575,10 @@ def waitForStringOrRegex(window, pane, args, isRegex):
         return
 
     # This will be treated as either string or regex depending on isRegex.
-    needle = args[0]
-    regexNeedle = re.compile(needle) if isRegex else None
+    # Literal strings are matched against the raw bytes of the pane, which is
+    # equivalent for UTF-8 and avoids decoding the pane on every poll.
+    needle = args[0].encode('utf-8')
+    regexNeedle = re.compile(args[0]) if isRegex else None
 
     pollingInterval = 1.0
     numLinesToCapture = 1
@@ -236,22 +586,64 @@ def waitForStringOrRegex(window, pane, args, isRegex):
         pollingInterval = float(args[1])
     if len(args) > 2:
         numLinesToCapture = int(args[2])
-    while True:
-        time.sleep(pollingInterval)
-
-        # Join lines so that we can capture a string spanning multiple lines.
-        rawHayStack = tget(
-            f"capture-pane -t ={sessionName}:{window}.{pane} -p").decode('utf-8')
-        # Need to strip to remove the trailing newline from output of capture-pane.
-        haystack = ''.join(rawHayStack.strip().split('\n')
-                           [-numLinesToCapture:])
-
-        if isRegex:
-            if regexNeedle.search(haystack):
-                return
-        else:
-            if needle in haystack:
-                return
+    # With a control pipe, the pane is also checked as soon as it produces
+    # output, so the polling interval only bounds how long a quiet pane goes
+    # unchecked. Without one, this falls back to plain polling.
+    target = paneTarget(window, pane)
+    pipe = controlPipe
+    paneOutput = None
+    if pipe:
+        paneId = tget(["display-message", "-p", "-t", target, "#{pane_id}"]).strip()
+        try:
+            paneOutput = pipe.watchPane(paneId)
+        except (OSError, EOFError, ValueError):
+            pass
+    # Schedule polls against the monotonic clock rather than sleeping for the
+    # full interval after each poll, so that the time spent capturing the pane
+    # does not accumulate as drift. A poll that overruns its slot is followed
+    # immediately by the next one instead of by a burst of catch-up polls.
+    nextPoll = time.monotonic() + pollingInterval
+    # Output only brings the next check forward, so that a busy pane is not
+    # captured more often than OUTPUT_CHECK_GAP allows.
+    outputCheckGap = min(OUTPUT_CHECK_GAP, pollingInterval)
+    lastCheck = float("-inf")
+    try:
+        while True:
+            timeout = max(0, nextPoll - time.monotonic())
+            if paneOutput is None:
+                time.sleep(timeout)
+            elif paneOutput.wait(timeout):
+                # Let a burst of output settle before looking at the pane.
+                checkAt = min(nextPoll, max(time.monotonic() + 0.01,
+                                            lastCheck + outputCheckGap))
+                time.sleep(max(0, checkAt - time.monotonic()))
+                paneOutput.clear()
+            now = time.monotonic()
+            lastCheck = now
+            if now >= nextPoll:
+                nextPoll = max(nextPoll + pollingInterval, now)
+
+            # Join lines so that we can capture a string spanning multiple lines.
+            # The control pipe is only held for the capture itself and not while
+            # sleeping, so with useThreads a pane waiting here does not hold up
+            # the commands sent to other panes.
+            rawHayStack = tget(["capture-pane", "-t", target, "-p"])
+            # Need to strip to remove the trailing newline from output of capture-pane.
+            # Only the lines being examined are split off and joined.
+            haystack = b''.join(rawHayStack.strip().rsplit(b'\n', numLinesToCapture)
+                                [-numLinesToCapture:])
+
+            if isRegex:
+                # Regexes are matched against text, so that character classes
+                # keep their meaning for non-ASCII input.
+                if regexNeedle.search(haystack.decode('utf-8')):
+                    return
+            else:
+                if needle in haystack:
+                    return
+    finally:
+        if paneOutput is not None:
+            pipe.unwatchPane(paneId)
 
 
 def digestCommands(commands):
@@ -284,39 +676,55 @@ def digestCommands(commands):
     commands: list(str)
       A list of raw commands from a call to `create`.
 
-    Returns
-    -------
-    list(str)
-      A list of strings with comments removed and #smux lines joined.
+    Yields
+    ------
+    str
+      The commands with comments removed and #smux lines joined, as they are
+      found, so that a caller can start sending the first commands without
+      waiting for the rest to be digested.
     """
-    rawCommands = [x for x in commands if x != '' and (
-        x.startswith("#smux ") or not x.startswith("#"))]
-    digestedCommands = []
     bufferedLine = None
-    for line in rawCommands:
+    for line in commands:
+        # Skip empty lines and comments in the same pass. Indexing is cheaper
+        # than a method call, and most lines are not comments.
+        if not line or (line[0] == "#" and not line.startswith("#smux ")):
+            continue
         # The previous line initiated a continuation.
-        if bufferedLine:
+        if bufferedLine is not None:
             bufferedLine += line
 
             # Check if next line should be joined.
-            if bufferedLine.endswith("\\"):
+            if bufferedLine[-1] == "\\":
                 bufferedLine = bufferedLine[:-1]
             else:
-                digestedCommands.append(bufferedLine)
+                yield bufferedLine
                 bufferedLine = None
-        # Previous line did not initiate or continue a continuation.
+        # Previous line did not initiate or continue a continuation. Few lines
+        # end in a backslash, so that is checked first.
+        elif line[-1] == "\\" and line.startswith("#smux "):
+            bufferedLine = line[:-1]
         else:
-            if line.startswith("#smux ") and line.endswith("\\"):
-                bufferedLine = line[:-1]
-            else:
-                digestedCommands.append(line)
+            yield line
     # The last line ended in a continuation for some reason.
     if bufferedLine:
-        digestedCommands.append(bufferedLine)
-    return digestedCommands
+        yield bufferedLine
+
 
+# Directives which do not go through the pane, but act on it or on things the
+# commands in it may have set up, such as a buffer filled by `tmux
+# load-buffer`. Without a pause they would overtake the commands typed just
+# before them, since pasting only hands the commands to the pane. The shell
+# directive is included because its command is as likely to depend on the
+# typed commands as the others.
+SETTLING_DIRECTIVES = frozenset(["paste-buffer", "send-keys", "shell"])
+# Seconds to give a pane to run the commands typed into it before one of the
+# directives above. This is the pause smux used to make before every command,
+# which is enough for a shell to run a short command such as `tmux
+# load-buffer`, while keeping the pause out of every other command.
+TYPED_COMMAND_SETTLE_TIME = 0.1
 
-def sendCommand(cmd, pane=0, window=None):
+
+def sendCommand(cmd, pane=0, window=None, target=None, afterTyping=False):
     """
     Send or execute a given command against a given pane.
 
@@ -330,72 +738,99 @@ def sendCommand(cmd, pane=0, window=None):
     ----------
     cmd: string
       The command to either execute or send to the target window and pane.
+      Commands to send may span several lines, which are then entered one
+      after another.
     window: int
       The window index, equivalent to the value returned by
-      `display-message #{window_index}` in the target window.
+      `display-message #{window_index}` in the target window. Callers must
+      always supply it, rather than have every command look up the current
+      window.
     pane: int
       The pane index, equivalent to the value returned by
       `display-message #{pane_index}` in the target pane.
+    target: str
+      If given, the tmux target for the window and pane, as returned by
+      paneTarget. Callers sending many commands to one pane can compute it
+      once instead of on every command.
+    afterTyping: bool
+      True means the previous command sent to the pane was typed into it, so
+      a directive in SETTLING_DIRECTIVES first waits TYPED_COMMAND_SETTLE_TIME
+      for the pane to run it.
     """
-    def prepareCommand(cmd):
-        """
-        "Escape" a string for use with send-keys.
-
-        Deal with single quotes inside command by spliting the command by single
-        quotes, wrapping the single quotes in double quotes, and wrapping the
-        other parts in single quotes.
-        """
-        if not "'" in cmd:
-            return "'' " + f"'{cmd}'"
-        return "'' " + '"\'"'.join(f"'{x}'" for x in cmd.split("'"))
-
-    time.sleep(0.1)
-    if not window:
-        window = getCurrentWindow()
+    if window is None:
+        raise ValueError("sendCommand requires a window")
+    if target is None:
+        target = paneTarget(window, pane)
     # If the command is a directive to smux itself, then execute it instead of
     # sending it to the pane directly.
     if cmd.startswith("#smux "):
-        # Skip the #smux prefix.
-        args = shlex.split(cmd)[1:]
-        if args[0] == 'paste-buffer':
-            tcmd(f"paste-buffer -t '={sessionName}:{window}.{pane}' " + shlex.join(args[1:]))
-        elif args[0] == 'send-keys':
+        # Skip the #smux prefix and split off the directive name from its
+        # arguments. The arguments are only tokenized with shlex by the
+        # directives that take quoted arguments, since shlex is slow.
+        _, directive, rest = (cmd.split(None, 2) + ["", ""])[:3]
+        if afterTyping and directive in SETTLING_DIRECTIVES:
+            syncControlPipe()
+            time.sleep(TYPED_COMMAND_SETTLE_TIME)
+        if directive == 'paste-buffer':
+            tcmd(["paste-buffer", "-t", target, *shlex.split(rest)])
+        elif directive == 'send-keys':
             # This option is useful for sending something like "Enter" with
             # semantic meaning, rather than literally. This is needed rather
             # than just allowing the script to directly invoke `tmux send-keys`
             # because the target pane may be running a completely different
             # process which we want to feed special input to (e.g. it is waiting
             # for the user to type a special key such as Enter).
-            tcmd(f"send-keys -t '={sessionName}:{window}.{pane}' " + shlex.join(args[1:]))
-        elif args[0] == 'sleep':
-            time.sleep(float(args[1]))
-        elif args[0] == 'shell':
+            tcmd(["send-keys", "-t", target, *shlex.split(rest)])
+        elif directive == 'sleep':
+            time.sleep(float(rest.split()[0]))
+        elif directive == 'shell':
             # Use the suffix of the original string, because
             # shlex.join(shlex.split(X))  turns double-quotes into
             # single-quotes, which is undesirable for expading variables.
-            fullCommand = f'export session_name={sessionName}; export window={window}; ' + \
-                f'export pane={pane}; ' + cmd[cmd.index("shell") + len("shell"):]
-            os.system(fullCommand)
-        elif args[0] == 'waitForString':
+            # The variables are passed in the environment rather than as
+            # export statements, so that they need no shell quoting.
+            env = dict(os.environ, session_name=sessionName, window=str(window),
+                       pane=str(pane))
+            # The command may use its own tmux client, so the commands
+            # already sent to the pane must have run first.
+            syncControlPipe()
+            run(["/bin/sh", "-c", rest], env=env, close_fds=False)
+        elif directive == 'waitForString':
             # This command and waitForRegex relies on capture-pane polling (not
             # pipe-pane), which implies that it only works if the string we are
             # waiting for sticks around on the screen for a while, rather than
             # scrolling by.
-            waitForStringOrRegex(window, pane, args[1:], False)
-        elif args[0] == 'waitForRegex':
-            waitForStringOrRegex(window, pane, args[1:], True)
+            waitForStringOrRegex(window, pane, shlex.split(rest), False)
+        elif directive == 'waitForRegex':
+            waitForStringOrRegex(window, pane, shlex.split(rest), True)
         return
 
-    tcmd(f"send-keys -t ={sessionName}:{window}.{pane} -l " + prepareCommand(cmd))
-    tcmd(f"send-keys -t ={sessionName}:{window}.{pane} Enter")
+    # The command is pasted from a buffer in one tmux command list, which
+    # writes it to the pane in one go rather than as one key press per
+    # character like `send-keys -l`. paste-buffer turns the trailing newline
+    # into the Enter that runs the command and -d deletes the buffer again.
+    # It is not a bracketed paste (-p), since a shell would then insert the
+    # newline instead of running the command. The command is passed as a
+    # single argument, so it needs no quoting, and `--` keeps a leading dash
+    # from being parsed as an option.
+    buffer = f"smux-{os.getpid()}-{window}.{pane}"
+    tcmd(["set-buffer", "-b", buffer, "--", cmd + "\n", ";",
+          "paste-buffer", "-d", "-b", buffer, "-t", target])
 
 
-# Capture these variables on import if we are inside a tmux, so that their
-# values do not change if the user moves around after invoking a slow command
-# with noCreate.
-if tmux:
-    callerWindow = getCurrentWindow()
-    callerPane = getCurrentPane()
+def getCallerPane():
+    """
+    Retrieve the window and pane index of the pane smux was invoked from.
+
+    The pane is looked up through TMUX_PANE when tmux provides it, so that the
+    result does not change if the user moves around after invoking a slow
+    command with noCreate.
+    """
+    args = ["display-message", "-p"]
+    if os.environ.get("TMUX_PANE"):
+        args += ["-t", os.environ["TMUX_PANE"]]
+    window, pane = tget([*args, "#I #P"]).split()
+    return int(window), int(pane)
 
 
 def create(numPanesPerWindow, commands, layout='tiled', executeAfterCreate=None, noCreate=False, useThreads=False):
@@ -407,9 +842,11 @@ def create(numPanesPerWindow, commands, layout='tiled', executeAfterCreate=None,
     numPanesPerWindow: int
       The number of panes to create in each window. If there are more lists of
       commands than numPanesPerWindow, more windows will be created.
-    commands : list(list(str))
+    commands : iterable(list(str))
       A list of command lists. Each command list will be send to a given pane.
-      The types of commands are documented in smux.__doc__.
+      The types of commands are documented in smux.__doc__. Any iterable can
+      be given, such as a generator reading a session file, in which case
+      each window is created as soon as its command lists are available.
     executeAfterCreate : Callable[[], None]
       A function that a client can pass in to be executed after creating the
       windows. For example, one can synchronize the panes by passing the following:
@@ -428,91 +865,148 @@ def create(numPanesPerWindow, commands, layout='tiled', executeAfterCreate=None,
       different panes are independent of each other's timing.
     """
 
-    def sendCommandList(commandList, window, pane):
+    def sendCommandList(commandList, window, pane, windowReady=None):
         """
         Send a set of commands to the given pane pane.
 
         This function is needed because lambdas cannot accept for loops for
-        threads.
+        threads. If windowReady is given, it is a Future which is waited on
+        before sending anything, for when the window becomes ready.
         """
-        # Sleep for 500 ms to give time for the tty to notice its new
-        # dimensions. Empirically, this prevents commands like `man tmux` from
-        # rendering with incorrect dimensions.
-        time.sleep(0.5)
-        for command in commandList:
-            sendCommand(command, pane, window)
+        if windowReady:
+            windowReady.result()
+        # Remove comments in commands and join together line-continuations
+        # for #smux commands. This is done here rather than up front, and as
+        # the commands are sent, so that with useThreads each pane digests its
+        # own commands in parallel with the other panes waiting on tmux.
+        commandList = digestCommands(commandList)
+        target = paneTarget(window, pane)
+        # Consecutive commands to type into the pane are sent as a single
+        # paste, while #smux directives still run one at a time and in order.
+        typed = False
+        for isDirective, group in groupby(commandList, lambda x: x.startswith("#smux ")):
+            if isDirective:
+                for command in group:
+                    sendCommand(command, pane, window, target, afterTyping=typed)
+                    typed = False
+            else:
+                sendCommand("\n".join(group), pane, window, target)
+                typed = True
 
     global sessionName
-    # Remove comments in commands and join together line-continuations for #smux
-    # commands.
-    for i in range(len(commands)):
-        commands[i] = digestCommands(commands[i])
-
     if not numPanesPerWindow > 0:
         print("No panes specified.")
         return
     if numPanesPerWindow > 50:
         print("Number per window must be less than 50!")
         return
-    if noCreate and (not tmux or len(commands) != 1):
+    # Only a list or another sized collection of command lists can be checked
+    # upfront. Other iterables are read a window at a time as they are created.
+    numCommands = len(commands) if hasattr(commands, "__len__") else None
+    if numCommands is not None and numCommands > MAX_PANES:
+        print(f"At most {MAX_PANES} panes can be created!")
+        return
+    if noCreate and tmux and numCommands is None:
+        # noCreate needs to know whether there is exactly one command list.
+        commands = list(commands)
+        numCommands = len(commands)
+    if noCreate and (not tmux or numCommands != 1):
         print("noCreate parameter ignored because we are not in a tmux session or len(commands) != 1")
     if not tmux:
-        rows, columns = os.popen('stty size', 'r').read().split()
-        sessionName = tget(f"new-session -d -x {columns} -y {rows} -P -F '#{{session_name}}'").decode('utf-8').strip()
+        # Size the session to the terminal that will attach to it. Like
+        # `stty size`, this asks the terminal on stdin, but without forking.
+        size = os.get_terminal_size(sys.stdin.fileno())
+        sessionName = tget(["new-session", "-d", "-x", str(size.columns), "-y", str(size.lines),
+                            "-P", "-F", "#{session_name}"]).decode('utf-8').strip()
+        # Every tmux command from here on goes to the new session, so send
+        # them through a single control mode client.
+        openControlPipe()
     elif noCreate and len(commands) == 1:
         # Run ourselves in a subshell, so that Python does not consume the input
         # intended for the new foreground processes started by the script.
+        # It is started directly rather than through a shell, in its own
+        # session so that it is not interrupted along with the foreground job.
         if not os.environ.get('SMUX_SUBSHELL'):
-            os.system(
-                f'SMUX_SUBSHELL=1 CALLER_WINDOW={callerWindow} CALLER_PANE={callerPane} {shlex.join(sys.argv)} & > /dev/null 2>&1')
+            callerWindow, callerPane = getCallerPane()
+            env = dict(os.environ, SMUX_SUBSHELL="1", CALLER_WINDOW=str(callerWindow),
+                       CALLER_PANE=str(callerPane))
+            Popen(sys.argv, env=env, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL,
+                  start_new_session=True, close_fds=False)
             return
 
         # Target the current window that invoked this command.
         currentWindow = int(os.environ.get("CALLER_WINDOW"))
         currentPane = int(os.environ.get("CALLER_PANE"))
+        openControlPipe()
         sendCommandList(commands[0], currentWindow, currentPane)
+        closeControlPipe()
         return
     else:
+        openControlPipe()
         newWindow()
 
-    panesNeeded = len(commands)
     # There is no benefit to threads if there is only one pane
-    useThreads = useThreads and panesNeeded > 1
-    threads = []
-    while panesNeeded > 0:
+    useThreads = useThreads and (numCommands is None or numCommands > 1)
+    # Each pane gets its own worker rather than sharing a smaller pool, because
+    # a pane blocked on a directive such as waitForString must not delay the
+    # other panes from starting. Windows are still carved on this thread, since
+    # split-window acts on the current window, but carving the next window
+    # overlaps with sending commands to the previous ones. Each window also
+    # gets a worker that waits for its panes to become ready, which the panes'
+    # workers wait on in turn, so this thread can move on to the next window
+    # straight away. The pool only starts threads as they are needed, so it
+    # can be sized for the most panes there may be.
+    maxPanes = MAX_PANES if numCommands is None else numCommands
+    numWindows = -(-maxPanes // numPanesPerWindow)
+    executor = ThreadPoolExecutor(max_workers=maxPanes + numWindows) if useThreads else None
+    futures = []
+    numPanes = 0
+    commands = iter(commands)
+    for windowCommands in iter(lambda: list(islice(commands, numPanesPerWindow)), []):
+        numPanes += len(windowCommands)
+        if numPanes > MAX_PANES:
+            print(f"At most {MAX_PANES} panes can be created!")
+            break
+        # Create a new window if necessary
+        if numPanes > len(windowCommands):
+            newWindow()
         windowNum = carvePanes(numPanesPerWindow, layout)
-        panesNeeded -= numPanesPerWindow
+        if useThreads:
+            windowReady = executor.submit(waitForWindowReady, windowNum)
+        else:
+            waitForWindowReady(windowNum)
 
         # Send the commands in with CR
-        for i in range(min(numPanesPerWindow, len(commands))):
-            print(i)
+        for i, commandList in enumerate(windowCommands):
             if useThreads:
-                # We use a list comprehension because Python disallows for loops in lists.
-                thread = threading.Thread(
-                    target=sendCommandList, args=(commands[i], windowNum, i))
-                thread.start()
-                threads.append(thread)
+                futures.append(executor.submit(
+                    sendCommandList, commandList, windowNum, i, windowReady))
             else:
-                sendCommandList(commands[i], windowNum, i)
-
-        # Pop off the commands we just finished with
-        for i in range(min(numPanesPerWindow, len(commands))):
-            commands.pop(0)
-
-        # Create a new window if necessary
-        if panesNeeded > 0:
-            newWindow()
-
-    for thread in threads:
-        thread.join()
-
-    # It is important to run this after the threads are joined, because only
-    # then can we be guaranteed that all panes are truly finished creating.
+                sendCommandList(commandList, windowNum, i)
+
+    # Waiting on the futures also raises any exception from the workers.
+    for future in futures:
+        future.result()
+    if executor:
+        executor.shutdown()
+
+    # It is important to run this after the threads are joined and the control
+    # pipe has caught up, because only then can we be guaranteed that all panes
+    # are truly finished creating.
+    syncControlPipe()
     if executeAfterCreate:
         executeAfterCreate()
 
+    # The control mode client must be detached before attaching the terminal.
+    closeControlPipe()
     if not tmux:
-        tcmd("attach-session")
+        # Not tcmd, since the tmux client needs the terminal as its stdout.
+        run(["tmux", "attach-session", "-t", f"={sessionName}"])
+
+
+# Options in the header of a session file that are given without a value.
+SESSION_FLAGS = frozenset(["NO_CREATE", "USE_THREADS", "PRESERVE_LEADING_WHITESPACE"])
+
 
 def startSession(file_):
     """
@@ -520,57 +1014,82 @@ def startSession(file_):
 
     Options are documented at the top of the file.
     """
-    cmds = []
-
     args = {"PANES_PER_WINDOW": None, "LAYOUT": "tiled", "NO_CREATE": False,
             "USE_THREADS": False, "PRESERVE_LEADING_WHITESPACE" : False}
-    cur_cmds = None
+    # The options end at the first pane specification.
+    inPanes = False
     for line in file_:
-        line = line.rstrip() if args['PRESERVE_LEADING_WHITESPACE'] else line.strip()
-        # Always strip leading whitespace on comments and smux directives
-        # Preservation only applies to non-smux directives.
-        if line.lstrip().startswith("#"):
-            line = line.lstrip()
-        # comments
-        if line == '' or (line.startswith("#") and not line.startswith("#smux ")):
+        line = line.strip()
+        if not line or line.startswith("#"):
             continue
-        # Start a new pane specification
         if line.startswith("---"):
-            if cur_cmds is not None:
-                cmds.append(cur_cmds)
-            cur_cmds = []
-            continue
-        # Configuration part
-        if cur_cmds == None:
-            try:
-                if line == 'NO_CREATE':
-                    args["NO_CREATE"] = True
-                elif line == 'USE_THREADS':
-                    args['USE_THREADS'] = True
-                elif line == 'PRESERVE_LEADING_WHITESPACE':
-                    args['PRESERVE_LEADING_WHITESPACE'] = True
-                else:
-                    left, right = line.split('=', 1)
-                    args[left.strip()] = right.strip()
-            except:
-                print("Argment '%s' ignored" % line)
-                print("Arguments must be in the form of key = value")
-                continue
-
-        else:  # Actual session is being added to
-            cur_cmds.append(line)
-
-    if cur_cmds:
-        cmds.append(cur_cmds)
+            inPanes = True
+            break
+        # Configuration part. Flags are named after the option they turn on.
+        if line in SESSION_FLAGS:
+            args[line] = True
+        elif "=" in line:
+            left, _, right = line.partition('=')
+            args[left.strip()] = right.strip()
+        else:
+            print("Argment '%s' ignored" % line)
+            print("Arguments must be in the form of key = value")
 
+    # The panes are handed to create as they are read, so that the first
+    # windows are set up while the rest of the file is still being read.
+    cmds = readPanes(file_, args['PRESERVE_LEADING_WHITESPACE']) if inPanes else []
     if args['PANES_PER_WINDOW'] is not None:
         panes_per_window = int(args['PANES_PER_WINDOW'])
     else:
+        # Without a window size every pane goes in one window, so they all
+        # have to be read before any can be created.
+        cmds = list(cmds)
         panes_per_window = len(cmds)
     create(panes_per_window, cmds, args['LAYOUT'], noCreate=args['NO_CREATE'],
            useThreads=args['USE_THREADS'])
 
 
+def readPanes(file_, preserveWhitespace=False):
+    """
+    Read the pane specifications that follow the first --- in a session file.
+
+    Parameters
+    ----------
+    file_ : file
+      The session file, positioned just after the first line starting with ---.
+    preserveWhitespace : bool
+      True means leading whitespace is kept on lines which are not comments or
+      smux directives.
+
+    Yields
+    ------
+    list(str)
+      The lines given for each pane, as each pane specification is completed.
+    """
+    cur_cmds = []
+    for line in file_:
+        line = line.rstrip() if preserveWhitespace else line.strip()
+        # Always strip leading whitespace on comments and smux directives
+        # Preservation only applies to non-smux directives.
+        stripped = line.lstrip() if preserveWhitespace else line
+        if stripped.startswith("#"):
+            # comments
+            if not stripped.startswith("#smux "):
+                continue
+            line = stripped
+        elif not line:
+            continue
+        # Start a new pane specification
+        if line.startswith("---"):
+            yield cur_cmds
+            cur_cmds = []
+        else:
+            cur_cmds.append(line)
+
+    if cur_cmds:
+        yield cur_cmds
+
+
 def usage():
     print(__doc__)
     sys.exit(1)